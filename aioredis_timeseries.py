@@ -5,9 +5,12 @@ __email__ = 'ryan.anguiano@gmail.com'
 __version__ = '0.0.1'
 
 
+import asyncio
 import calendar
 import functools
-import operator
+import hashlib
+import itertools
+import time
 from datetime import datetime
 
 try:
@@ -15,18 +18,43 @@ try:
 except ImportError:  # pragma: no cover
     pytz = None
 
+_UTC = pytz.utc if pytz else None
+
 
 __all__ = ['AsyncTimeSeries', 'seconds', 'minutes', 'hours', 'days']
 
 
+# Increments every granularity's bucket and refreshes its TTL in one call,
+# returning the new value of each bucket.
+# KEYS: hash key per granularity
+# ARGV: increment command, amount, then (bucket, ttl) per granularity
+_INCREASE_SCRIPT = """
+local values = {}
+for i, hkey in ipairs(KEYS) do
+    local ttl = tonumber(ARGV[i * 2 + 2])
+    values[i] = redis.call(ARGV[1], hkey, ARGV[i * 2 + 1], ARGV[2])
+    -- TTL rounds to the nearest second, so this skips the write for about
+    -- half a second after the expiry was last refreshed
+    if redis.call('TTL', hkey) ~= ttl then
+        redis.call('EXPIRE', hkey, ttl)
+    end
+end
+return values
+"""
+_INCREASE_SHA = hashlib.sha1(_INCREASE_SCRIPT.encode('utf-8')).hexdigest()
+
+
 seconds = lambda i: i
 minutes = lambda i: i * seconds(60)
 hours = lambda i: i * minutes(60)
 days = lambda i: i * hours(24)
 
+_DAY = days(1)
+_EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
 
 class AsyncTimeSeries:
-    granularities = {
+    default_granularities = {
         '1minute': {'duration': minutes(1), 'ttl': hours(1)},
         '5minute': {'duration': minutes(5), 'ttl': hours(6)},
         '10minute': {'duration': minutes(10), 'ttl': hours(12)},
@@ -35,136 +63,315 @@ class AsyncTimeSeries:
     }
 
     def __init__(self, client, base_key='stats', use_float=False,
-                 timezone=None, granularities=None):
+                 timezone=None, granularities=None, max_chain_ops=None,
+                 flush_interval=None):
         self.client = client
-        self.base_key = base_key
+        self._base_key = base_key
         self.use_float = use_float
         self.timezone = timezone
-        self.granularities = granularities or self.granularities
+        self._granularities = granularities or self.default_granularities
+        self.max_chain_ops = max_chain_ops
+        self.flush_interval = flush_interval
         self.chain = self.client.pipeline()
+        self._chain_calls = []
+        self._last_flush = time.monotonic()
+        self._build_tables()
+
+    # The lookup tables below are derived from these, so rebuild on assignment
+    @property
+    def base_key(self):
+        return self._base_key
+
+    @base_key.setter
+    def base_key(self, value):
+        self._base_key = value
+        self._build_tables()
+
+    @property
+    def granularities(self):
+        return self._granularities
+
+    @granularities.setter
+    def granularities(self, value):
+        self._granularities = value
+        self._build_tables()
+
+    def _build_tables(self):
+        # (name, duration, ttl, max count) per granularity, for the hot paths
+        self._gran = [
+            (name, props['duration'], props['ttl'],
+             props['ttl'] // props['duration'])
+            for name, props in self.granularities.items()
+        ]
+        self._gran_by_name = {gran[0]: gran for gran in self._gran}
+        self._key_prefix = {
+            name: '{}:{}:'.format(self.base_key, name).encode('utf-8')
+            for name in self.granularities
+        }
+        # (duration, ttl, key prefix, whole-day buckets) per granularity
+        self._incr_plan = [
+            (duration, ttl, self._key_prefix[name], duration % _DAY == 0)
+            for name, duration, ttl, _ in self._gran
+        ]
 
     def get_key(self, key, timestamp, granularity):
-        ttl = self.granularities[granularity]['ttl']
-        timestamp_key = round_time(timestamp, ttl)  # No timezone offset in the key
-        return ':'.join([self.base_key, granularity, str(timestamp_key), str(key)])
+        hkey = self._get_key_from_unix(key, _to_unix(timestamp), granularity)
+        return hkey.decode('utf-8')
+
+    def _get_key_from_unix(self, key, unix_ts, granularity):
+        ttl = self._gran_by_name[granularity][2]
+        timestamp_key = _round_unix(unix_ts, ttl)  # No timezone offset in the key
+        return b''.join([
+            self._key_prefix[granularity],
+            str(timestamp_key).encode(),
+            b':',
+            str(key).encode('utf-8'),
+        ])
 
     async def increase(self, key, amount, timestamp=None, execute=True):
-        pipe = self.client.pipeline() if execute else self.chain
-
-        for granularity, props in self.granularities.items():
-            hkey = self.get_key(key, timestamp, granularity)
-            bucket = round_time_with_tz(timestamp, props['duration'], self.timezone)
-
-            _incr = pipe.hincrbyfloat if self.use_float else pipe.hincrby
-            _incr(hkey, bucket, amount)
-
-            pipe.expire(hkey, props['ttl'])
-
-        if execute:
-            await pipe.execute()
+        call = self._queue_increase(self.chain, key, amount, timestamp)
+        self._chain_calls.append(call)
+
+        if execute and self._should_flush():
+            await self.execute()
+
+    def _queue_increase(self, pipe, key, amount, timestamp):
+        unix_ts = _to_unix(timestamp)
+        key_suffix = b':' + str(key).encode('utf-8')
+        hkeys = []
+        args = ['HINCRBYFLOAT' if self.use_float else 'HINCRBY', amount]
+        tz = self.timezone
+        for duration, ttl, prefix, whole_days in self._incr_plan:
+            hkeys.append(prefix + str(unix_ts // ttl * ttl).encode() + key_suffix)
+            if tz and whole_days:
+                bucket = _round_unix_with_tz(unix_ts, duration, tz)
+            else:
+                bucket = unix_ts // duration * duration
+            args.extend((bucket, ttl))
+        return pipe.evalsha(_INCREASE_SHA, keys=hkeys, args=args), hkeys, args
+
+    async def _execute_increases(self, pipe, calls):
+        raw = await pipe.execute(return_exceptions=True)
+
+        # EVALSHA fails with NOSCRIPT until the script is cached (first use,
+        # server restart, SCRIPT FLUSH), so load it and replay only those calls
+        futures = [fut for fut, _, _ in calls]
+        failed = [call for call in calls if _is_noscript(call[0].exception())]
+        replayed = {}
+        if failed:
+            await self.client.script_load(_INCREASE_SCRIPT)
+            retry = self.client.pipeline()
+            for _, hkeys, args in failed:
+                retry.evalsha(_INCREASE_SHA, keys=hkeys, args=args)
+            replies = await retry.execute()
+            replayed = dict(zip([fut for fut, _, _ in failed], replies))
+
+        # raw also holds replies to commands queued directly on self.chain;
+        # each of our futures resolves to its own object, in pipeline order.
+        # Script replies are expanded to the (value, True) pairs that
+        # separate HINCRBY and EXPIRE commands used to return.
+        _type = float if self.use_float else int
+        results = []
+        pending = iter(futures)
+        fut = next(pending, None)
+        for result in raw:
+            if fut is not None and result is _future_outcome(fut):
+                result = replayed.get(fut, result)
+                fut = next(pending, None)
+                if not isinstance(result, Exception):
+                    for value in result:
+                        results.extend((_type(value), True))
+                    continue
+            results.append(result)
+
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            raise pipe.error_class(errors)
+        return results
 
     async def decrease(self, key, amount, timestamp=None, execute=True):
         await self.increase(key, -1 * amount, timestamp, execute)
 
     async def execute(self):
-        results = await self.chain.execute()
-        self.chain = self.client.pipeline()
-        return results
+        # Swap the chain out first so concurrent callers queue onto a fresh one
+        chain, self.chain = self.chain, self.client.pipeline()
+        calls, self._chain_calls = self._chain_calls, []
+        self._last_flush = time.monotonic()
+        return await self._execute_increases(chain, calls)
+
+    def _should_flush(self):
+        if self.max_chain_ops is None and self.flush_interval is None:
+            return True
+        if self.max_chain_ops is not None:
+            if len(self._chain_calls) >= self.max_chain_ops:
+                return True
+        if self.flush_interval is not None:
+            return time.monotonic() - self._last_flush >= self.flush_interval
+        return False
 
     async def get_buckets(self, key, granularity, count, timestamp=None):
-        props = self.granularities[granularity]
-        if count > (props['ttl'] / props['duration']):
+        buckets, raw = await self._get_bucket_values(
+            key, granularity, count, timestamp)
+        if self.use_float:
+            results = [float(x) if x else 0.0 for x in raw]
+        else:
+            results = [int(x) if x else 0 for x in raw]
+        return list(zip(map(unix_to_dt, buckets), results))
+
+    async def _get_bucket_values(self, key, granularity, count, timestamp=None):
+        # Returns the unix bucket range and an iterator of the raw replies
+        _, duration, ttl, limit = self._gran_by_name[granularity]
+        if count > limit:
             raise ValueError('Count exceeds granularity limit')
 
-        pipe = self.client.pipeline()
-        buckets = []
-        rounded = round_time_with_tz(timestamp, props['duration'], self.timezone)
-        bucket = rounded - (count * props['duration'])
+        rounded = _round_unix_with_tz(_to_unix(timestamp), duration, self.timezone)
+        buckets = range(rounded - (count - 1) * duration, rounded + 1, duration)
 
-        for _ in range(count):
-            bucket += props['duration']
-            buckets.append(unix_to_dt(bucket))
-            pipe.hget(self.get_key(key, bucket, granularity), bucket)
+        # Buckets in the same ttl window live in the same hash
+        requests = [
+            (self._get_key_from_unix(key, fields[0], granularity), fields)
+            for fields in _split_by_window(buckets, ttl)
+        ]
 
-        _type = float if self.use_float else int
-        parse = lambda x: _type(x or 0)
+        replies = await self._hmget_all(requests)
+        return buckets, itertools.chain.from_iterable(replies)
 
-        results = map(parse, await pipe.execute())
+    async def _hmget_all(self, requests):
+        # aioredis pipelines are single-use, so don't build one for a single hash
+        if len(requests) == 1:
+            hkey, fields = requests[0]
+            return [await self.client.hmget(hkey, *fields)]
 
-        return list(zip(buckets, results))
+        pipe = self.client.pipeline()
+        for hkey, fields in requests:
+            pipe.hmget(hkey, *fields)
+        return await pipe.execute()
 
     async def get_total(self, *args, **kwargs):
-        return sum([
-            amount for bucket, amount in await self.get_buckets(*args, **kwargs)
-        ])
+        _, raw = await self._get_bucket_values(*args, **kwargs)
+        _type = float if self.use_float else int
+        return sum(map(_type, filter(None, raw)), _type())
 
     async def scan_keys(self, granularity, count, search='*', timestamp=None):
-        props = self.granularities[granularity]
-        if count > (props['ttl'] / props['duration']):
+        _, duration, _, limit = self._gran_by_name[granularity]
+        if count > limit:
             raise ValueError('Count exceeds granularity limit')
 
-        hkeys = set()
-        prefixes = set()
-        rounded = round_time_with_tz(timestamp, props['duration'], self.timezone)
-        bucket = rounded - (count * props['duration'])
-
-        for _ in range(count):
-            bucket += props['duration']
-            hkeys.add(self.get_key(search, bucket, granularity))
-            prefixes.add(self.get_key('', bucket, granularity))
+        rounded = _round_unix_with_tz(_to_unix(timestamp), duration, self.timezone)
+        hkeys = {
+            self._get_key_from_unix(search, bucket, granularity)
+            for bucket in range(
+                rounded - (count - 1) * duration, rounded + 1, duration)
+        }
 
-        pipe = self.client.pipeline()
-        for key in hkeys:
-            pipe.keys(key)
-        results = functools.reduce(operator.add, await pipe.execute())
+        results = set()
+        await asyncio.gather(
+            *[self._scan_match(pattern, results) for pattern in hkeys])
 
-        parsed = set()
-        for result in results:
-            result = result.decode('utf-8')
-            for prefix in prefixes:
-                result = result.replace(prefix, '')
-            parsed.add(result)
+        # Keys are formatted as base_key:granularity:timestamp:key
+        depth = self.base_key.count(':') + granularity.count(':') + 3
+        parsed = {
+            result.split(b':', depth)[depth].decode('utf-8')
+            for result in results
+        }
 
         return sorted(parsed)
 
+    async def _scan_match(self, pattern, results):
+        # Each SCAN checks out its own connection when the client is a pool,
+        # so the gathered patterns are scanned in parallel
+        cursor = 0
+        while True:
+            cursor, keys = await self.client.scan(cursor, match=pattern, count=500)
+            results.update(keys)
+            if not cursor:
+                break
+
     async def record_hit(self, key, timestamp=None, count=1, execute=True):
         await self.increase(key, count, timestamp, execute)
 
+    async def record_hits_batch(self, events):
+        # events is an iterable of (key, count, timestamp) tuples
+        pipe = self.client.pipeline()
+        calls = [
+            self._queue_increase(pipe, key, count, timestamp)
+            for key, count, timestamp in events
+        ]
+        await self._execute_increases(pipe, calls)
+
     async def remove_hit(self, key, timestamp=None, count=1, execute=True):
         await self.decrease(key, count, timestamp, execute)
 
+    flush = execute
     get_hits = get_buckets
     get_total_hits = get_total
 
 
 def round_time(dt, precision):
-    seconds = dt_to_unix(dt or tz_now())
-    return int((seconds // precision) * precision)
+    return _round_unix(_to_unix(dt), precision)
 
 
 def round_time_with_tz(dt, precision, tz=None):
-    rounded = round_time(dt, precision)
+    return _round_unix_with_tz(_to_unix(dt), precision, tz)
+
+
+def _round_unix(seconds, precision):
+    return seconds // precision * precision
+
+
+def _round_unix_with_tz(seconds, precision, tz=None):
+    rounded = seconds // precision * precision
+
+    # Only whole-day buckets are shifted to the timezone's midnight
+    if not tz or precision % _DAY:
+        return rounded
 
-    if tz and precision % days(1) == 0:
-        rounded_dt = unix_to_dt(rounded).replace(tzinfo=None)
-        offset = tz.utcoffset(rounded_dt).total_seconds()
-        rounded = int(rounded - offset)
+    offset = _utcoffset_seconds(tz, rounded // _DAY + _EPOCH_ORDINAL)
+    rounded -= offset
 
-        dt = unix_to_dt(dt or tz_now())
-        dt_seconds = (hours(dt.hour) + minutes(dt.minute) + seconds(dt.second))
-        if offset < 0 and dt_seconds < abs(offset):
-            rounded -= precision
-        elif offset > 0 and dt_seconds >= days(1) - offset:
-            rounded += precision
+    dt_seconds = seconds % _DAY  # Seconds since midnight UTC
+    if offset < 0 and dt_seconds < abs(offset):
+        rounded -= precision
+    elif offset > 0 and dt_seconds >= _DAY - offset:
+        rounded += precision
 
     return rounded
 
 
-def tz_now():
-    if pytz:
-        return datetime.utcnow().replace(tzinfo=pytz.utc)
-    else:
-        return datetime.now()
+def _future_outcome(fut):
+    exc = fut.exception()
+    return fut.result() if exc is None else exc
+
+
+def _is_noscript(exc):
+    return exc is not None and str(exc).startswith('NOSCRIPT')
+
+
+def _split_by_window(buckets, window):
+    # Slice a bucket range at window boundaries without visiting each bucket
+    groups = []
+    start = 0
+    while start < len(buckets):
+        first = buckets[start]
+        stop = start - (first - (first // window + 1) * window) // buckets.step
+        groups.append(buckets[start:stop])
+        start = stop
+    return groups
+
+
+@functools.lru_cache(maxsize=4096)
+def _utcoffset_seconds(tz, ordinal):
+    # Offset at midnight of the given day; only changes on DST transitions
+    return int(tz.utcoffset(datetime.fromordinal(ordinal)).total_seconds())
+
+
+if pytz:
+    def tz_now():
+        return datetime.now(_UTC)
+else:  # pragma: no cover
+    def tz_now():
+        # Naive datetimes are read as UTC, matching the time.time() default
+        return datetime.utcnow()
 
 
 def dt_to_unix(dt):
@@ -173,8 +380,28 @@ def dt_to_unix(dt):
     return dt
 
 
+def _unix_now():
+    return int(time.time())
+
+
+def _to_unix(dt):
+    # Normalize a public timestamp argument to int seconds once, up front
+    if not dt:
+        return _unix_now()
+    return int(_dt_to_unix_fast(dt))
+
+
+def _dt_to_unix_fast(dt):
+    # datetime.timestamp() is much cheaper than timegm(utctimetuple()), but
+    # would treat naive datetimes as local time, so only use it when aware
+    if isinstance(dt, datetime):
+        if dt.tzinfo is not None:
+            return int(dt.timestamp())
+        return calendar.timegm(dt.utctimetuple())
+    return dt
+
+
 def unix_to_dt(dt):
     if isinstance(dt, (int, float)):
-        utc = pytz.utc if pytz else None
-        dt = datetime.fromtimestamp(dt, utc)
+        dt = datetime.fromtimestamp(dt, _UTC)
     return dt
@@ -10,6 +10,9 @@ Tests for `aioredis_timeseries` module.
 
 from collections import OrderedDict
 from datetime import datetime, timedelta
+import importlib.util
+import sys
+import time
 import pytest
 import pytz
 
@@ -75,15 +78,95 @@ async def test_record_hit_datetime(ts):
     assert await ts.get_total_hits('event:123', '1m', 2, now) == 1
 
 
+@pytest.mark.asyncio
+async def test_record_hit_expire(ts):
+    await ts.record_hit('event:123')
+    for granularity, props in TEST_GRANULARITIES.items():
+        hkey = ts.get_key('event:123', None, granularity)
+        assert 0 < await ts.client.ttl(hkey) <= props['ttl']
+
+
+@pytest.mark.asyncio
+async def test_record_hit_expire_refresh(ts):
+    now = timeseries.tz_now()
+    ttl_ms = TEST_GRANULARITIES['1m']['ttl'] * 1000
+    await ts.record_hit('event:123', now)
+    hkey = ts.get_key('event:123', now, '1m')
+
+    # TTL still rounds up to the full ttl, so the next hit skips the EXPIRE
+    await ts.client.pexpire(hkey, ttl_ms - 100)
+    await ts.record_hit('event:123', now)
+    assert 0 < await ts.client.pttl(hkey) <= ttl_ms - 100
+
+    # An expiry that has run down is refreshed
+    await ts.client.expire(hkey, 10)
+    await ts.record_hit('event:123', now)
+    assert ttl_ms - 1000 < await ts.client.pttl(hkey) <= ttl_ms
+
+    assert await ts.get_total_hits('event:123', '1m', 1, now) == 3
+
+
+@pytest.mark.asyncio
+async def test_record_hit_script_flushed(ts):
+    await ts.client.script_flush()
+    await ts.record_hit('event:123', execute=False)
+    await ts.record_hit('event:123')
+    await ts.client.script_flush()
+    await ts.record_hits_batch([('event:123', 1, None)])
+    assert await ts.get_total_hits('event:123', '1m', 1) == 3
+
+
 @pytest.mark.asyncio
 async def test_record_hit_chain(ts):
     await ts.record_hit('event:123', execute=False)
     await ts.record_hit('enter:123', execute=False)
-    await ts.execute()
+    assert await ts.execute() == [1, True] * len(TEST_GRANULARITIES) * 2
     assert await ts.get_total_hits('event:123', '1m', 1) == 1
     assert await ts.get_total_hits('enter:123', '1m', 1) == 1
 
 
+@pytest.mark.asyncio
+async def test_record_hit_max_chain_ops(redis_client):
+    ts = timeseries.AsyncTimeSeries(redis_client, 'tests', granularities=TEST_GRANULARITIES,
+                                    max_chain_ops=2)
+    await ts.record_hit('event:123')
+    assert await ts.get_total_hits('event:123', '1m', 1) == 0
+    await ts.record_hit('event:123')
+    assert await ts.get_total_hits('event:123', '1m', 1) == 2
+
+
+@pytest.mark.asyncio
+async def test_record_hit_flush_interval(redis_client):
+    ts = timeseries.AsyncTimeSeries(redis_client, 'tests', granularities=TEST_GRANULARITIES,
+                                    flush_interval=60)
+    await ts.record_hit('event:123')
+    assert await ts.get_total_hits('event:123', '1m', 1) == 0
+    await ts.flush()
+    assert await ts.get_total_hits('event:123', '1m', 1) == 1
+
+
+@pytest.mark.asyncio
+async def test_record_hits_batch(ts):
+    now = timeseries.tz_now()
+    await ts.record_hits_batch([
+        ('event:123', 1, now),
+        ('event:123', 2, now - timedelta(minutes=1)),
+        ('enter:123', 3, now),
+    ])
+    assert await ts.get_total_hits('event:123', '1m', 2, now) == 3
+    assert await ts.get_total_hits('enter:123', '1m', 1, now) == 3
+
+
+@pytest.mark.asyncio
+async def test_execute_results_with_user_commands(ts):
+    await ts.client.script_flush()
+    ts.chain.set('tests:plain', 'x')
+    await ts.increase('event:123', 2, execute=False)
+    ts.chain.get('tests:plain')
+    results = await ts.execute()
+    assert results == [True] + [2, True] * len(TEST_GRANULARITIES) + [b'x']
+
+
 @pytest.mark.asyncio
 async def test_get_hits(ts):
     now = timeseries.tz_now()
@@ -107,6 +190,19 @@ async def test_get_hits(ts):
     assert hits[4][1] == 1
 
 
+@pytest.mark.asyncio
+async def test_get_hits_across_ttl_windows(ts):
+    now = datetime(2017, 1, 1, 12, 30, tzinfo=pytz.utc)
+    await ts.record_hit('event:123', datetime(2017, 1, 1, 11, 45, tzinfo=pytz.utc))
+    await ts.record_hit('event:123', datetime(2017, 1, 1, 12, 15, tzinfo=pytz.utc), count=2)
+    hits = await ts.get_hits('event:123', '1m', 60, now)
+    assert len(hits) == 60
+    assert hits[0][0] == datetime(2017, 1, 1, 11, 31, tzinfo=pytz.utc)
+    assert hits[14] == (datetime(2017, 1, 1, 11, 45, tzinfo=pytz.utc), 1)
+    assert hits[44] == (datetime(2017, 1, 1, 12, 15, tzinfo=pytz.utc), 2)
+    assert sum(amount for bucket, amount in hits) == 3
+
+
 @pytest.mark.asyncio
 async def test_get_hits_invalid_count(ts):
     with pytest.raises(ValueError):
@@ -123,16 +219,30 @@ async def test_get_total_hits(ts):
     assert await ts.get_total_hits('event:123', '1m', 5) == 4
 
 
+@pytest.fixture
+def timeseries_no_pytz(monkeypatch):
+    # pytz is picked up at import time, so load a separate copy without it
+    monkeypatch.setitem(sys.modules, 'pytz', None)
+    spec = importlib.util.find_spec('aioredis_timeseries')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
 @pytest.mark.asyncio
-async def test_get_total_hits_no_pytz(ts):
-    timeseries.pytz, _pytz = None, timeseries.pytz
-    now = timeseries.tz_now()
+async def test_get_total_hits_no_pytz(redis_client, timeseries_no_pytz):
+    assert timeseries_no_pytz.pytz is None
+    now = timeseries_no_pytz.tz_now()
+    assert now.tzinfo is None
+    assert abs(timeseries_no_pytz.dt_to_unix(now) - time.time()) < 5
+
+    ts = timeseries_no_pytz.AsyncTimeSeries(redis_client, 'tests', granularities=TEST_GRANULARITIES)
     await ts.record_hit('event:123', now - timedelta(minutes=4))
     await ts.record_hit('event:123', now - timedelta(minutes=2))
     await ts.record_hit('event:123', now - timedelta(minutes=1))
-    await ts.record_hit('event:123')
-    assert await ts.get_total_hits('event:123', '1m', 5) == 4
-    timeseries.pytz = _pytz
+    await ts.record_hit('event:123', now)
+    assert await ts.get_total_hits('event:123', '1m', 5, now) == 4
+    assert ts.get_key('event:123', now, '1m') == ts.get_key('event:123', None, '1m')
 
 
 @pytest.mark.asyncio
@@ -156,6 +266,43 @@ async def test_scan_keys_search(ts):
     assert await ts.scan_keys('1m', 1, 'event:*') == ['event:123', 'event:456']
 
 
+@pytest.mark.asyncio
+async def test_scan_keys_pool():
+    import aioredis
+    pool = await aioredis.create_redis_pool('redis://localhost/9', minsize=2, maxsize=4)
+    ts = timeseries.AsyncTimeSeries(pool, 'tests', granularities=TEST_GRANULARITIES)
+    try:
+        await pool.flushdb()
+        now = timeseries.tz_now()
+        for i in range(100):
+            await ts.record_hit('event:{}'.format(i), now - timedelta(minutes=i % 60))
+        assert len(await ts.scan_keys('1m', 60, timestamp=now)) == 100
+    finally:
+        pool.close()
+        await pool.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_scan_keys_nested_base_key(redis_client):
+    ts = timeseries.AsyncTimeSeries(redis_client, 'tests:nested', granularities=TEST_GRANULARITIES)
+    await ts.record_hit('event:123')
+    await ts.record_hit('event:456')
+    assert await ts.scan_keys('1m', 1) == ['event:123', 'event:456']
+
+
+@pytest.mark.asyncio
+async def test_reassign_attributes(redis_client):
+    ts = timeseries.AsyncTimeSeries(redis_client, 'tests', granularities=TEST_GRANULARITIES)
+    ts.base_key = 'reassigned'
+    ts.timezone = eastern
+    ts.granularities = OrderedDict([('1d', TEST_GRANULARITIES['1d'])])
+    now = datetime(2017, 7, 16, 3, tzinfo=pytz.utc)
+    await ts.record_hit('event:123', now)
+    assert await ts.get_total_hits('event:123', '1d', 1, now) == 1
+    assert ts.get_key('event:123', now, '1d').startswith('reassigned:1d:')
+    assert await ts.scan_keys('1d', 1, timestamp=now) == ['event:123']
+
+
 @pytest.mark.asyncio
 async def test_float_increase(ts_float):
     ts = ts_float
@@ -167,7 +314,8 @@ async def test_float_increase(ts_float):
 async def test_float_decrease(ts_float):
     ts = ts_float
     await ts.increase('account:123', 5)
-    await ts.decrease('account:123', 2.5)
+    await ts.decrease('account:123', 2.5, execute=False)
+    assert await ts.execute() == [2.5, True] * len(TEST_GRANULARITIES)
     assert await ts.get_total_hits('account:123', '1m', 1) == 2.5
 
 